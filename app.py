@@ -1,18 +1,73 @@
+from dotenv import load_dotenv
+
+# Load .env before importing the blueprints, which read their settings at import
+load_dotenv()
+
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from routes.routes import main
-from routes.ai import ai
+from routes.ai import ai, limiter
 from models.database import db
+from jinja2 import FileSystemBytecodeCache
+from flask_compress import Compress
+import orjson
 import os
-from dotenv import load_dotenv  
 
-load_dotenv()
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson for jsonify() and request.get_json().
+    Non-str keys are coerced and keys are sorted when sort_keys is set, as
+    with the default provider. Calls passing stdlib json options (e.g. the
+    session serializer's object_hook) are handed to the default provider.
+    """
+
+    def _orjson_option(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_option()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self._orjson_option()),
+            mimetype=self.mimetype
+        )
 
 def create_app():
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret")
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///app.db")
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # Keep compiled templates on disk so a restarted worker skips recompiling them
+    jinja_cache_dir = os.path.join(app.instance_path, "jinja-cache")
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+    # Set through jinja_options: cache_size is only read when the environment is built
+    app.jinja_options = {
+        **app.jinja_options,
+        "bytecode_cache": FileSystemBytecodeCache(jinja_cache_dir),
+        "cache_size": 1000  # Room for every template and partial, so none is recompiled
+    }
+    # Compress pages and JSON; the NDJSON chat stream is left alone so tokens aren't held back
+    app.config["COMPRESS_MIMETYPES"] = ["text/html", "text/css", "application/javascript", "application/json"]
+    app.config["COMPRESS_LEVEL"] = 5
+    app.config["COMPRESS_MIN_SIZE"] = 500
+    app.config["COMPRESS_STREAMS"] = False
     db.init_app(app)
+    limiter.init_app(app)
+    Compress(app)
 
     with app.app_context():
         db.create_all()
@@ -22,5 +77,6 @@ def create_app():
     return app
 
 if __name__ == '__main__':
+    # Development server only; see gunicorn_conf.py for running in production
     app = create_app()
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=os.getenv("FLASK_ENV") == "development")
\ No newline at end of file
@@ -0,0 +1,21 @@
+# Production server settings, run with:
+#   gunicorn -c gunicorn_conf.py "app:create_app()"
+# Chat history and rate-limit counters are per process unless REDIS_URL is set,
+# so configure Redis when running more than one worker. The Ollama worker pool
+# and the chat queue limit are always per process; post_fork below splits
+# OLLAMA_NUM_PARALLEL between the workers so together they match Ollama's slots.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Threaded workers: each streaming chat holds a thread while Ollama generates
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+keepalive = 30
+# Must outlast OLLAMA_TIMEOUT so slow generations aren't killed mid-stream
+timeout = int(os.getenv("OLLAMA_TIMEOUT", "120")) + 60
+
+def post_fork(server, worker):
+    # Runs in each worker before the app is imported (preload_app must stay off)
+    slots = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+    os.environ["OLLAMA_WORKER_SLOTS"] = str(max(1, slots // server.cfg.workers))
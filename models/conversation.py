@@ -0,0 +1,105 @@
+from collections import OrderedDict, deque
+import redis
+import threading
+import orjson
+import time
+
+
+class ConversationCache:
+    """
+    In-memory chat history per user.
+    Keeps at most max_users conversations (least recently used are evicted first),
+    drops conversations idle for longer than ttl_seconds and caps each one at
+    max_messages, discarding the oldest messages.
+    """
+
+    def __init__(self, max_users=1000, max_messages=24, ttl_seconds=3600):
+        self.max_users = max_users
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user_id -> (last_used, deque of messages)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return a copy of the user's messages, oldest first"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return []
+            self._entries[user_id] = (now, entry[1])
+            self._entries.move_to_end(user_id)
+            return list(entry[1])
+
+    def append(self, user_id, *messages):
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(user_id)
+            conversation = entry[1] if entry else deque(maxlen=self.max_messages)
+            conversation.extend(messages)
+            self._put(user_id, now, conversation)
+
+    def clear(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _put(self, user_id, now, conversation):
+        self._entries[user_id] = (now, conversation)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def _expire(self, now):
+        # Entries are ordered by last use, so stop at the first one still fresh
+        while self._entries:
+            last_used, _ = next(iter(self._entries.values()))
+            if now - last_used < self.ttl_seconds:
+                break
+            self._entries.popitem(last=False)
+
+
+class RedisConversationStore:
+    """
+    Chat history kept in a Redis list per user (chat:<user_id>), shared by all
+    workers and kept across restarts.
+    Falls back to an in-memory store whenever Redis is unavailable.
+    """
+
+    def __init__(self, client, fallback, max_messages=24, ttl_seconds=3600):
+        self.client = client
+        self.fallback = fallback
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def _key(user_id):
+        return f'chat:{user_id}'
+
+    def get(self, user_id):
+        """Return the user's messages, oldest first"""
+        try:
+            return [orjson.loads(m) for m in self.client.lrange(self._key(user_id), 0, -1)]
+        except redis.RedisError as e:
+            print(f"Redis unavailable, using in-memory history: {str(e)}")
+            return self.fallback.get(user_id)
+
+    def append(self, user_id, *messages):
+        key = self._key(user_id)
+        try:
+            # Push, trim and refresh the expiry in a single round-trip
+            pipe = self.client.pipeline()
+            pipe.rpush(key, *[orjson.dumps(m) for m in messages])
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl_seconds)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Redis unavailable, using in-memory history: {str(e)}")
+            self.fallback.append(user_id, *messages)
+
+    def clear(self, user_id):
+        self.fallback.clear(user_id)
+        try:
+            self.client.delete(self._key(user_id))
+        except redis.RedisError as e:
+            print(f"Redis unavailable, cleared in-memory history only: {str(e)}")
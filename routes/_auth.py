@@ -0,0 +1,27 @@
+from flask import jsonify, flash, redirect, url_for, session
+from functools import wraps
+
+# Login required decorator
+def login_required(f=None, *, api=False):
+    """
+    Decorator to protect routes that require authentication.
+    Page routes redirect to the login page if user is not in session;
+    with api=True a JSON 401 is returned instead.
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if 'user_id' not in session:
+                if api:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Unauthorized'
+                    }), 401
+                flash("Please log in to access this page", "warning")
+                return redirect(url_for('main.login'))
+            return view(*args, **kwargs)
+        return decorated_function
+
+    if f is not None:
+        return decorator(f)
+    return decorator
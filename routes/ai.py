@@ -1,168 +1,325 @@
-from flask import Blueprint, jsonify, request, session
+from flask import Blueprint, Response, jsonify, request, session, stream_with_context
 from models.database import db, User
-from functools import wraps
+from models.conversation import ConversationCache, RedisConversationStore
+from ._auth import login_required
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import redis
+import atexit
+import hashlib
+import orjson
+import queue
+import threading
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 ai = Blueprint("ai", __name__)
 
-conversation_cache = {}
+# Keep last 24 messages (12 exchanges) - good balance for IoT context
+MAX_MESSAGES = 24
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "1000"))
+CONVERSATION_TTL_SECONDS = int(os.getenv("CONVERSATION_TTL_SECONDS", "3600"))
+REDIS_URL = os.getenv("REDIS_URL")  # e.g. redis://localhost:6379/0, shares history across workers
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "1"))  # Seconds per Redis connect/command
+
+conversation_cache = ConversationCache(
+    max_users=MAX_CONVERSATIONS,
+    max_messages=MAX_MESSAGES,
+    ttl_seconds=CONVERSATION_TTL_SECONDS
+)
+if REDIS_URL:
+    conversation_cache = RedisConversationStore(
+        # Short timeouts so an unreachable Redis falls back to memory quickly
+        redis.Redis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT
+        ),
+        fallback=conversation_cache,
+        max_messages=MAX_MESSAGES,
+        ttl_seconds=CONVERSATION_TTL_SECONDS
+    )
 
 def get_user_conversation(user_id):
-    if user_id not in conversation_cache:
-        conversation_cache[user_id] = []
-    return conversation_cache[user_id]
+    return conversation_cache.get(user_id)
 
 def clear_user_conversation(user_id):
-    if user_id in conversation_cache:
-        conversation_cache[user_id] = []
+    conversation_cache.clear(user_id)
+
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+MODEL_NAME = os.getenv("MODEL_NAME", "llama3.1:8b")  # Optimized for your 16GB RAM
+OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "120"))  # 2 minutes for 8b model
+OLLAMA_CONNECT_TIMEOUT = int(os.getenv("OLLAMA_CONNECT_TIMEOUT", "10"))  # Fail fast when Ollama is down
+CHAT_URL = OLLAMA_API_URL.replace('/api/generate', '/api/chat')
+# Ollama slots this process may use: all of OLLAMA_NUM_PARALLEL, or this worker's
+# share of it when gunicorn_conf.py splits the slots between workers
+NUM_PARALLEL = int(os.getenv("OLLAMA_WORKER_SLOTS", os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+MAX_QUEUED_CHATS = int(os.getenv("MAX_QUEUED_CHATS", str(NUM_PARALLEL * 2)))  # Waiting beyond the running slots
+CHAT_RATE_LIMIT = os.getenv("CHAT_RATE_LIMIT", "10/minute;2/second")
+
+# Per-user limits on /api/chat, shared across workers when Redis is configured.
+# If Redis goes down the counters move to memory instead of failing the request.
+limiter = Limiter(
+    key_func=lambda: session.get('user_id') or get_remote_address(),
+    storage_uri=REDIS_URL or "memory://",
+    storage_options={'socket_connect_timeout': REDIS_TIMEOUT, 'socket_timeout': REDIS_TIMEOUT},
+    in_memory_fallback_enabled=True
+)
+
+# Chats running or waiting for an Ollama slot in this process; beyond this we answer 503 at once
+_chat_slots = threading.BoundedSemaphore(NUM_PARALLEL + MAX_QUEUED_CHATS)
+
+# System prompt for IoT dashboard context
+SYSTEM_MSG = {
+    'role': 'system',
+    'content': 'You are an expert AI assistant specialized in IoT dashboard design and development. You help users create modern, responsive IoT dashboards with focus on: data visualization (charts, graphs, real-time metrics), IoT device management, sensor data monitoring, user interface design, and best practices for dashboard architecture. Provide practical, actionable, and technical advice. Be concise but thorough.'
+}
+
+# Request fields shared by every chat call; only "messages" changes per turn
+_BASE_PAYLOAD = {
+    "model": MODEL_NAME,
+    "stream": True,
+    "options": {
+        "temperature": 0.7,       # Balanced creativity
+        "num_predict": 1024,      # Longer responses for detailed explanations
+        "top_k": 40,
+        "top_p": 0.9,
+        "num_ctx": 8192,          # Large context window for technical discussions
+        "repeat_penalty": 1.1,    # Avoid repetition
+        "num_thread": 10          # Use all 10 CPU cores
+    }
+}
 
-# Login required decorator
-def login_required(f):
+# Static for the life of the process, so serialized once
+_MODEL_INFO_JSON = orjson.dumps({
+    'success': True,
+    'model': MODEL_NAME,
+    'timeout': OLLAMA_TIMEOUT,
+    'max_context': _BASE_PAYLOAD['options']['num_ctx']
+})
+
+# Shared HTTP session so every chat turn reuses a kept-alive connection to Ollama
+_OLLAMA_SESSION = requests.Session()
+# Only the _OLLAMA_POOL workers use the session, so one kept-alive connection per worker
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=NUM_PARALLEL, max_retries=0)
+_OLLAMA_SESSION.mount('http://', _adapter)
+_OLLAMA_SESSION.mount('https://', _adapter)
+_OLLAMA_SESSION.headers.update({
+    'Accept-Encoding': 'gzip',
+    'Connection': 'keep-alive'
+})
+atexit.register(_OLLAMA_SESSION.close)
+
+# Ollama calls run on a fixed pool sized to its parallel slots; further requests
+# wait in the pool's FIFO queue instead of piling onto the model server
+_OLLAMA_POOL = ThreadPoolExecutor(max_workers=NUM_PARALLEL, thread_name_prefix='ollama')
+atexit.register(_OLLAMA_POOL.shutdown, wait=False, cancel_futures=True)
+_STREAM_END = object()
+
+def _stream_chat(payload, out, cancelled):
     """
-    Decorator to protect routes that require authentication.
-    Redirects to login page if user is not in session.
+    Runs on an _OLLAMA_POOL worker: posts one chat request and relays the
+    status code, then each response line, then _STREAM_END to the out queue.
+    Errors are relayed as exception objects.
     """
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return jsonify({
-                'success': False,
-                'error': 'Unauthorized'
-            }), 401
-        return f(*args, **kwargs)
-    return decorated_function
+    try:
+        if cancelled.is_set():  # client left while this request was queued
+            return
+        with _OLLAMA_SESSION.post(
+            CHAT_URL,
+            data=orjson.dumps(payload),
+            headers={'Content-Type': 'application/json'},
+            stream=True,
+            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUT)
+        ) as response:
+            out.put(response.status_code)
+            if response.status_code == 200:
+                for line in response.iter_lines():
+                    if cancelled.is_set():  # client went away, free the slot
+                        break
+                    if line:
+                        out.put(line)
+    except Exception as e:
+        out.put(e)
+    finally:
+        out.put(_STREAM_END)
 
+def _relay(out):
+    """Yield items from a _stream_chat queue, re-raising relayed errors"""
+    while True:
+        item = out.get()
+        if item is _STREAM_END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
 
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
-MODEL_NAME = os.getenv("MODEL_NAME", "llama3.1:8b")  # Optimized for your 16GB RAM
-OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "120"))  # 2 minutes for 8b model
+@ai.errorhandler(429)
+def rate_limited(e):
+    return jsonify({
+        'success': False,
+        'error': f'Too many requests ({e.description}). Please wait a moment and try again.'
+    }), 429
 
 @ai.route('/api/chat', methods=['POST'])
-@login_required
+@login_required(api=True)
+@limiter.limit(CHAT_RATE_LIMIT)
 def chat_api():
     user_id = session['user_id']
     conversation = get_user_conversation(user_id)
-    
-    try:
-        data = request.get_json()
-        user_message = data.get('message', '')
 
-        if not user_message:
-            return jsonify({
-                'success': False,
-                'error': 'No message provided'
-            }), 400
-
-        # Add user message to conversation
-        conversation.append({
-            'role': 'user',
-            'content': user_message
-        })
-
-        # Construct the correct API URL
-        chat_url = OLLAMA_API_URL.replace('/api/generate', '/api/chat')
-        
-        # System prompt for IoT dashboard context
-        messages = conversation.copy()
-        if len(messages) == 1:  # First message in conversation
-            messages.insert(0, {
-                'role': 'system',
-                'content': 'You are an expert AI assistant specialized in IoT dashboard design and development. You help users create modern, responsive IoT dashboards with focus on: data visualization (charts, graphs, real-time metrics), IoT device management, sensor data monitoring, user interface design, and best practices for dashboard architecture. Provide practical, actionable, and technical advice. Be concise but thorough.'
-            })
+    data = request.get_json(silent=True)
+    user_message = data.get('message', '') if isinstance(data, dict) else ''
 
-        response = requests.post(
-            chat_url,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,       # Balanced creativity
-                    "num_predict": 1024,      # Longer responses for detailed explanations
-                    "top_k": 40,
-                    "top_p": 0.9,
-                    "num_ctx": 8192,          # Large context window for technical discussions
-                    "repeat_penalty": 1.1,    # Avoid repetition
-                    "num_thread": 10          # Use all 10 CPU cores
-                }
-            },
-            timeout=OLLAMA_TIMEOUT
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result.get('message', {}).get('content', '')
-
-            # Only add assistant response if we got valid content
-            if ai_response:
-                conversation.append({
-                    'role': 'assistant',
-                    'content': ai_response
-                })
+    if not user_message or not isinstance(user_message, str):
+        return jsonify({
+            'success': False,
+            'error': 'No message provided'
+        }), 400
 
-                # Trim conversation to prevent memory issues
-                # Keep last 24 messages (12 exchanges) - good balance for IoT context
-                MAX_MESSAGES = 24
-                if len(conversation) > MAX_MESSAGES:
-                    conversation_cache[user_id] = conversation[-MAX_MESSAGES:]
+    # The user message is only stored once the model has answered it
+    user_entry = {
+        'role': 'user',
+        'content': user_message
+    }
 
-                return jsonify({
-                    'success': True,
-                    'response': ai_response,
-                    'model': MODEL_NAME
-                })
-            else:
-                # No valid response received, remove user message
-                if conversation and conversation[-1]['role'] == 'user':
-                    conversation.pop()
-                return jsonify({
-                    'success': False,
-                    'error': 'Empty response from AI model'
-                }), 500
-        else:
-            # API returned error status, remove user message
-            if conversation and conversation[-1]['role'] == 'user':
-                conversation.pop()
-            return jsonify({
-                'success': False,
-                'error': f'Ollama API error: {response.status_code}'
-            }), 500
+    # System prompt leads every request; it is never stored, so trimming can't drop it
+    messages = [SYSTEM_MSG, *conversation, user_entry]
+
+    payload = {**_BASE_PAYLOAD, "messages": messages}
 
-    except requests.exceptions.Timeout:
-        # Clean up conversation on timeout
-        if conversation and conversation[-1]['role'] == 'user':
-            conversation.pop()
+    if not _chat_slots.acquire(blocking=False):
         return jsonify({
             'success': False,
-            'error': f'Request timed out after {OLLAMA_TIMEOUT} seconds. The model might be busy. Please try again.'
-        }), 504
+            'error': 'The AI model is busy with other requests. Please try again shortly.'
+        }), 503
 
-    except requests.exceptions.ConnectionError:
-        # Clean up conversation on connection error
-        if conversation and conversation[-1]['role'] == 'user':
-            conversation.pop()
+    out = queue.Queue()
+    cancelled = threading.Event()
+    lines = _relay(out)
+
+    # Wait until Ollama accepts or refuses the request, so failures keep a proper HTTP status
+    try:
+        _OLLAMA_POOL.submit(_stream_chat, payload, out, cancelled)
+        status_code = next(lines)
+    except Exception as e:
+        cancelled.set()
+        _chat_slots.release()
+        error, status = _request_error(e)
         return jsonify({
             'success': False,
-            'error': 'Cannot connect to Ollama. Make sure Ollama is running with: ollama serve'
-        }), 500
+            'error': error
+        }), status
 
-    except Exception as e:
-        # Clean up conversation on any other error
-        print(f"Error: {str(e)}")
-        if conversation and conversation[-1]['role'] == 'user':
-            conversation.pop()
+    if status_code != 200:
+        cancelled.set()
+        _chat_slots.release()
         return jsonify({
             'success': False,
-            'error': f'An error occurred: {str(e)}'
+            'error': f'Ollama API error: {status_code}'
         }), 500
 
+    def generate():
+        # Each line sent to the client is one JSON object: content deltas while
+        # the model is generating, then a final "done" (or "error") line.
+        parts = []
+        completed = False  # set once Ollama reports the answer is finished
+        try:
+            for line in lines:
+                chunk = orjson.loads(line)
+                if 'error' in chunk:
+                    yield _ndjson({
+                        'success': False,
+                        'error': f"Ollama API error: {chunk['error']}"
+                    })
+                    return
+
+                content = (chunk.get('message') or {}).get('content', '')
+                if content:
+                    parts.append(content)
+                    yield _ndjson({
+                        'success': True,
+                        'response': content
+                    })
+                if chunk.get('done'):
+                    completed = True
+                    break
+
+            if not parts:
+                yield _ndjson({
+                    'success': False,
+                    'error': 'Empty response from AI model'
+                })
+            elif not completed:
+                # Stream closed before Ollama's final chunk, the answer is cut short
+                yield _ndjson({
+                    'success': False,
+                    'error': 'The AI response was interrupted. Please try again.'
+                })
+            else:
+                yield _ndjson({
+                    'success': True,
+                    'done': True,
+                    'model': MODEL_NAME
+                })
+
+        except Exception as e:
+            # Headers are already sent, so the error goes out as the last frame
+            error, _ = _request_error(e)
+            yield _ndjson({
+                'success': False,
+                'error': error
+            })
+
+        finally:
+            # Runs on completion, on errors and when the client disconnects;
+            # only a finished answer is kept, like the turn was dropped on errors before
+            cancelled.set()
+            if completed and parts:
+                conversation_cache.append(user_id, user_entry, {
+                    'role': 'assistant',
+                    'content': ''.join(parts)
+                })
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Run when the server closes the response, even if the stream never started
+    response.call_on_close(cancelled.set)
+    response.call_on_close(_chat_slots.release)
+    return response
+
+
+def _request_error(e):
+    """Return the user-facing error message and HTTP status for a failed Ollama call"""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        if _is_read_timeout(e):
+            return f'Request timed out after {OLLAMA_TIMEOUT} seconds. The model might be busy. Please try again.', 504
+        return 'Cannot connect to Ollama. Make sure Ollama is running with: ollama serve', 500
+    print(f"Error: {str(e)}")
+    return f'An error occurred: {str(e)}', 500
+
+
+def _is_read_timeout(e):
+    """
+    True when Ollama accepted the request but stopped sending within OLLAMA_TIMEOUT.
+    A stall while streaming surfaces from iter_lines as ConnectionError(ReadTimeoutError),
+    while ConnectTimeout means Ollama could not be reached at all.
+    """
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return bool(e.args) and isinstance(e.args[0], ReadTimeoutError)
+
+
+def _ndjson(obj):
+    """Encode one newline-delimited JSON frame for the chat stream"""
+    return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
 
 @ai.route('/api/chat/clear', methods=['POST'])
-@login_required
+@login_required(api=True)
 def clear_chat():
     user_id = session['user_id']
     clear_user_conversation(user_id)
@@ -172,21 +329,32 @@ def clear_chat():
     })
 
 @ai.route('/api/chat/history', methods=['GET'])
-@login_required
+@login_required(api=True)
 def get_chat_history():
     user_id = session['user_id']
-    return jsonify({
+    body = orjson.dumps({
         'success': True,
         'history': get_user_conversation(user_id)
     })
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+
+    # Unchanged history: let the browser reuse its copy
+    if _etag_matches(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _etag_matches(etag):
+    # Flask-Compress appends ":<encoding>" to the ETag of compressed responses
+    return any(tag.split(':')[0] == etag for tag in request.if_none_match.as_set(include_weak=True))
 
 @ai.route('/api/chat/model', methods=['GET'])
-@login_required
+@login_required(api=True)
 def get_model_info():
     """Get current model information"""
-    return jsonify({
-        'success': True,
-        'model': MODEL_NAME,
-        'timeout': OLLAMA_TIMEOUT,
-        'max_context': 8192
-    })
\ No newline at end of file
+    return Response(_MODEL_INFO_JSON, mimetype='application/json', headers={
+        'Cache-Control': 'private, max-age=3600'
+    })
@@ -1,22 +1,23 @@
-from flask import Blueprint, render_template, jsonify, request, flash, redirect, url_for, session
+from flask import Blueprint, render_template, jsonify, request, flash, redirect, url_for, session, g
 from models.database import db, User
-from functools import wraps
+from ._auth import login_required
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash
 
 main = Blueprint("main", __name__)
 
-# Login required decorator
-def login_required(f):
-    """
-    Decorator to protect routes that require authentication.
-    Redirects to login page if user is not in session.
-    """
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash("Please log in to access this page", "warning")
-            return redirect(url_for('main.login'))
-        return f(*args, **kwargs)
-    return decorated_function
+# Checked when no account matches, so a failed login costs the same either way
+_DUMMY_PASSWORD_HASH = generate_password_hash("not-a-real-password")
+
+def get_user_by_email(email):
+    return db.session.execute(db.select(User).where(User.email == email)).scalar_one_or_none()
+
+@main.before_request
+def load_current_user():
+    # Look the logged-in user up once per request; views read it from g.user
+    g.user = None
+    if 'user_id' in session:
+        g.user = db.session.get(User, session['user_id'])
 
 @main.route('/')
 def home():
@@ -29,25 +30,25 @@ def login():
 @main.route('/chat')
 @login_required
 def chat():
-    user = User.query.get(session['user_id'])
+    user = g.user
     return render_template("user/chat.html", user=user)
 
 @main.route('/dashboard')
 @login_required
 def dashboard():
-    user = User.query.get(session['user_id'])
+    user = g.user
     return render_template("user/dashboard.html", user=user)
 
 @main.route('/projects/drafts')
 @login_required
 def drafts():
-    user = User.query.get(session['user_id'])
+    user = g.user
     return render_template("user/draft.html", user=user)
 
 @main.route('/my-projects')
 @login_required
 def projects():
-    user = User.query.get(session['user_id'])
+    user = g.user
     return render_template("user/projects.html", user=user)
 
 @main.route('/Sign-Up', methods=["GET"])
@@ -57,7 +58,7 @@ def SignUp():
 @main.route('/Settings')
 @login_required
 def Settings():
-    user = User.query.get(session['user_id'])
+    user = g.user
     return render_template("user/settings.html", user=user)
 
 #----------------------------POST ROUTES---------------------------------
@@ -66,7 +67,9 @@ def Settings():
 def login_post():
     email = request.form.get("email")
     password = request.form.get("password")
-    user = User.query.filter_by(email=email).first()
+    user = get_user_by_email(email)
+    if not user:
+        check_password_hash(_DUMMY_PASSWORD_HASH, password or "")
     if not user or not user.check_password(password):
         flash("Invalid email or password", "danger")
         return redirect(url_for("main.login"))
@@ -82,7 +85,7 @@ def register_post():
     email = request.form.get("email")
     password = request.form.get("password")
 
-    existing_user = User.query.filter_by(email=email).first()
+    existing_user = get_user_by_email(email)
     if existing_user:
         flash("Email already registered", "danger")
         return redirect(url_for("main.SignUp"))
@@ -90,7 +93,13 @@ def register_post():
     user = User(firstname=first_name, lastname=last_name, email=email)
     user.set_password(password)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another registration with this email committed first
+        db.session.rollback()
+        flash("Email already registered", "danger")
+        return redirect(url_for("main.SignUp"))
 
     flash("Account created successfully. Please log in.", "success")
     return redirect(url_for("main.login"))
@@ -106,7 +115,7 @@ def logout():
 def delete_account():
     try:
         # Get the current user
-        user = User.query.get(session['user_id'])
+        user = g.user
         
         if user:
             # Delete the user from database
@@ -142,18 +151,6 @@ def change_password():
             flash("All fields are required.", "danger")
             return redirect(url_for("main.Settings"))
         
-        # Get current user
-        user = User.query.get(session['user_id'])
-        
-        if not user:
-            flash("User not found.", "danger")
-            return redirect(url_for("main.Settings"))
-        
-        # Verify current password
-        if not user.check_password(current_password):
-            flash("Current password is incorrect.", "danger")
-            return redirect(url_for("main.Settings"))
-        
         # Check if new passwords match
         if new_password != confirm_password:
             flash("New passwords do not match.", "danger")
@@ -164,6 +161,23 @@ def change_password():
             flash("Password must be at least 6 characters long.", "danger")
             return redirect(url_for("main.Settings"))
         
+        # Reject reusing the current password
+        if new_password == current_password:
+            flash("New password must be different from the current password.", "danger")
+            return redirect(url_for("main.Settings"))
+        
+        # Get current user
+        user = g.user
+        
+        if not user:
+            flash("User not found.", "danger")
+            return redirect(url_for("main.Settings"))
+        
+        # Verify current password last, it is the only expensive check
+        if not user.check_password(current_password):
+            flash("Current password is incorrect.", "danger")
+            return redirect(url_for("main.Settings"))
+        
         # Update password
         user.set_password(new_password)
         db.session.commit()
@@ -192,7 +206,7 @@ def update_profile():
             return redirect(url_for("main.Settings"))
         
         # Get current user
-        user = User.query.get(session['user_id'])
+        user = g.user
         
         if not user:
             flash("User not found.", "danger")